@@ -3,7 +3,6 @@
 from unicorn.arm_const import *
 import struct
 from ...models.sd import SDModel
-from hal_fuzz.models.disk import Disk
 from hal_fuzz.utilities.ffsmu import FFSMU
 from hal_fuzz.handlers.fuzz import get_fuzz, fuzz_remaining
 from ...exit import do_exit
@@ -26,10 +25,16 @@ if the file is in the correct format, then read again to perform some other oper
 """
 INPUT_READ_LIMIT = 4
 
+# emulated SD card (one per process), replaced by a new card with the input loaded in HAL_SD_Init()
+sd_card = SDModel()
+
 # HAL_StatusTypeDef HAL_SD_Init(SD_HandleTypeDef *hsd)
 def HAL_SD_Init(uc):
-    # load input to fuzz into SDModel
-    d = Disk(SDModel.BLOCK_SIZE)
+    global sd_card
+    sd_card = SDModel()
+
+    # load input to fuzz into the SD card disk
+    d = sd_card.disk
     d.import_from_dictionary('mediadict')
     fs = FFSMU(d)
     fs.ls()
@@ -42,8 +47,6 @@ def HAL_SD_Init(uc):
 
     fs.create_file('image01.bmp', input)
 
-    SDModel.disk = d    # replace disk
-
     # get hsd base pointer
     hsd_bp = uc.reg_read(UC_ARM_REG_R0)
 
@@ -200,7 +203,7 @@ def HAL_SD_WriteBlocks(uc):
 
     # TODO refractor this part
     if number_of_blocks == 1:
-        SDModel.disk.write_block(block_add, bytes(uc.mem[data_p:data_p + data_length]))
+        sd_card.disk.write_block(block_add, bytes(uc.mem[data_p:data_p + data_length]))
     else:
         print("ERROR: MULTI BLOCK WRITE NOT SUPPORTED")
 
@@ -229,11 +232,13 @@ def HAL_SD_ReadBlocks(uc):
 
     # TODO refractor this part
     if number_of_blocks == 1:
-        data = SDModel.disk.read_block(block_add)
+        disk = sd_card.disk
+        data = disk.read_block(block_add)
         # check for input read limit
         if INPUT_READ_LIMIT != 0:
-            for addr in SDModel.disk.raw_data:
-                if SDModel.disk.read_count[addr] > INPUT_READ_LIMIT:
+            read_count = disk.read_count
+            for addr in disk.raw_data:
+                if read_count[addr] > INPUT_READ_LIMIT:
                     do_exit(0)
         # place the content inside the correct buffer
         #  uc.mem_write(hsd_bp + context_offset, struct.pack("<I", state))
@@ -1,13 +1,19 @@
 # Author Giuliani Daniele
 
-import re
 import struct
 
+# blocks are stored in chunks of CHUNK_BLOCKS consecutive blocks, a chunk is allocated only when
+# one of its blocks is written (a firmware can write to any address of the card)
+CHUNK_BLOCKS = 64
+
 
 class Disk:
-    def __init__(self, block_size):
-        self.content = {}               # content of the disk
+    def __init__(self, block_size, block_count=None):
         self.block_size = block_size    # block size
+        self.block_count = block_count  # capacity of the disk in blocks (None for unlimited)
+        self.chunks = {}                # content of the disk, chunk index: bytearray of CHUNK_BLOCKS blocks
+        self.present = {}               # chunk index: bitmap (int), bit n set if block n of the chunk is not empty
+        self.empty_block = bytes(block_size)
 
         """
         This parameters are used in order to limit the reading on blocks containing the input data
@@ -42,30 +48,62 @@ class Disk:
             self.write_block(block_num, new_block, mark_as_raw_data)
 
     def write_block(self, addr, content, mark_as_raw_data=False):
+        block_size = self.block_size    # local names, this is called for every block written
         # write block
-        if (len(content) != self.block_size) | (type(content) != bytes):
+        if (len(content) != block_size) | (type(content) != bytes):
             print('Disk write_block() error: bad content length')
+        elif addr < 0 or (self.block_count is not None and addr >= self.block_count):
+            print('Disk write_block() error: block address out of range')
         else:
-            # when trying to write an empty block (all zeros) remove the entry from the dictionary
-            if content == bytes(self.block_size):
-                self.content.pop(addr, None)
-            else:
-                self.content[addr] = content
+            index, offset = divmod(addr, CHUNK_BLOCKS)
+            start = offset * block_size
+            bit = 1 << offset
+            bitmap = self.present.get(index, 0)
+            if content != self.empty_block:
+                chunk = self.chunks.get(index)
+                if chunk is None:
+                    chunk = self.chunks[index] = bytearray(CHUNK_BLOCKS * block_size)
+                chunk[start:start + block_size] = content
+                self.present[index] = bitmap | bit
+            elif bitmap & bit:
+                # when writing an empty block (all zeros) the block is marked as not present,
+                # chunks without blocks are freed
+                bitmap &= ~bit
+                if bitmap:
+                    self.chunks[index][start:start + block_size] = content
+                    self.present[index] = bitmap
+                else:
+                    del self.chunks[index]
+                    del self.present[index]
             # mark block as raw data if needed
             if mark_as_raw_data:
                 self.mark_block_as_raw_data(addr)
 
+    def _stored_block(self, addr):
+        """Return the content of a block that is not empty (None otherwise), without counting the read."""
+        index, offset = divmod(addr, CHUNK_BLOCKS)
+        if (self.present.get(index, 0) >> offset) & 1:
+            start = offset * self.block_size
+            with memoryview(self.chunks[index]) as view:
+                return view[start:start + self.block_size].tobytes()
+        return None
+
     def read_block(self, addr):
-        # initialize return value as block (512 bytes) of zeros
-        block = bytes(self.block_size)
+        # this is called for every block read by the firmware: the lookup of _stored_block()
+        # is inlined (one divmod, no extra call) and attributes are bound to local names
+        index, offset = divmod(addr, CHUNK_BLOCKS)
         # if block exists return it
-        if addr in self.content:
-            block = self.content[addr]
-        # increase read counter
-        if addr in self.read_count:
-            self.read_count[addr] = self.read_count[addr] + 1
+        if (self.present.get(index, 0) >> offset) & 1:
+            block_size = self.block_size
+            start = offset * block_size
+            with memoryview(self.chunks[index]) as view:
+                block = view[start:start + block_size].tobytes()
         else:
-            self.read_count[addr] = 1
+            # (shared) block of zeros
+            block = self.empty_block
+        # increase read counter
+        read_count = self.read_count
+        read_count[addr] = read_count.get(addr, 0) + 1
         return block
 
     def mark_block_as_raw_data(self, addr):
@@ -75,49 +113,83 @@ class Disk:
 
     def get_block_count(self):
         """Return the number of blocks written (that are not empty) on the disk"""
-        return len(self.content.keys())
+        return sum(bin(bitmap).count('1') for bitmap in self.present.values())
 
     def get_block_list(self):
         """Return the list of addresses of blocks not empty."""
         blocks = []
-        for addr in self.content.keys():
-            blocks.append(addr)
+        for index in sorted(self.present):
+            bitmap = self.present[index]
+            while bitmap:
+                lowest = bitmap & -bitmap
+                blocks.append(index * CHUNK_BLOCKS + lowest.bit_length() - 1)
+                bitmap ^= lowest
         return blocks
 
+    def iter_blocks(self):
+        """
+        Yield (address, content) for every block that is not empty, in address order.
+        Walks the chunks directly (no lookup per address), to analyse or export the whole disk.
+        The disk must not be modified while iterating.
+        """
+        block_size = self.block_size
+        for index in sorted(self.present):
+            bitmap = self.present[index]
+            with memoryview(self.chunks[index]) as view:
+                while bitmap:
+                    lowest = bitmap & -bitmap
+                    offset = lowest.bit_length() - 1
+                    start = offset * block_size
+                    yield index * CHUNK_BLOCKS + offset, view[start:start + block_size].tobytes()
+                    bitmap ^= lowest
+
     def print_block(self, addr):
         """Pretty print of a block."""
-        if addr in self.content:
-            block = self.content[addr]
-            block_string = re.sub("(.{32})", "\\1\n", block.hex(), 0, re.DOTALL)
-            block_string = re.sub("(.{2})", "\\1 ", block_string, 0)
-            print(block_string)
+        block = self._stored_block(addr)
+        if block is not None:
+            # 16 bytes per line, bytes separated by spaces
+            block_hex = block.hex()
+            lines = []
+            for i in range(0, len(block_hex), 32):
+                line = block_hex[i:i + 32]
+                lines.append(' '.join(line[j:j + 2] for j in range(0, len(line), 2)))
+            print('\n'.join(lines))
         else:
             print("This block does not exist!")
 
     def export_as_image(self, name):
         """Export disk as binary image file that can be mounted."""
         path = './' + name
-        f = open(path, 'wb')
-        block_list = self.get_block_list()
-        block_list.sort()
-        first_block = block_list[0]
-        last_block = block_list[-1]
-        for i in range(first_block, last_block + 1):
-            f.write(self.read_block(i))
-        f.close()
+        if not self.present:
+            print("Disk export_as_image() error: the disk is empty")
+            return
+        # first and last blocks that are not empty
+        first_index = min(self.present)
+        last_index = max(self.present)
+        first_bitmap = self.present[first_index]
+        first_offset = (first_bitmap & -first_bitmap).bit_length() - 1
+        last_offset = self.present[last_index].bit_length() - 1
+        # empty blocks are zero filled in the chunks, write whole chunks (without copying them)
+        empty_chunk = bytes(CHUNK_BLOCKS * self.block_size)
+        with open(path, 'wb') as f:
+            for index in range(first_index, last_index + 1):
+                chunk = self.chunks.get(index, empty_chunk)
+                start = first_offset * self.block_size if index == first_index else 0
+                end = (last_offset + 1) * self.block_size if index == last_index else len(chunk)
+                with memoryview(chunk) as view:
+                    f.write(view[start:end])
 
     def import_from_image(self, name):
         """Import disk from a binary image."""
         path = './' + name
-        f = open(path, 'rb')
-        addr = 0
-        while True:
-            buff = f.read(self.block_size)
-            if len(buff) == 0:
-                break   # EOF reached
-            self.write_block(addr, buff)
-            addr = addr + 1
-        f.close()
+        with open(path, 'rb') as f:
+            addr = 0
+            while True:
+                buff = f.read(self.block_size)
+                if len(buff) == 0:
+                    break   # EOF reached
+                self.write_block(addr, buff)
+                addr = addr + 1
 
     def import_from_dictionary(self, name):
         """
@@ -127,16 +199,16 @@ class Disk:
         - "block content" is an array of size "block_size"
         """
         path = './' + name
-        f = open(path, 'rb')
-        while True:
-            buff = f.read(4 + self.block_size)
-            if len(buff) == 0:
-                break   # EOF reached
-            a_bytes = buff[:4]
-            block = buff[4:]
-            addr = struct.unpack('>I', a_bytes)[0]
+        with open(path, 'rb') as f:
+            data = f.read()
+        record = struct.Struct('>I{}s'.format(self.block_size))
+        # only complete records can be unpacked
+        trailing = len(data) % record.size
+        if trailing != 0:
+            print('Disk import_from_dictionary() error: truncated record at end of file')
+            data = memoryview(data)[:len(data) - trailing]
+        for addr, block in record.iter_unpack(data):
             self.write_block(addr, block)
-        f.close()
 
     def export_as_dictionary(self, name):
         """
@@ -146,8 +218,7 @@ class Disk:
         - "block content" is an array of size "block_size"
         """
         path = './' + name
-        f = open(path, 'wb')
-        for k, v in self.content.items():
-            f.write(struct.pack('>I', k))
-            f.write(v)
-        f.close()
\ No newline at end of file
+        record = struct.Struct('>I{}s'.format(self.block_size))
+        data = b''.join(record.pack(addr, block) for addr, block in self.iter_blocks())
+        with open(path, 'wb') as f:
+            f.write(data)
@@ -5,19 +5,35 @@
 # stm32f4xx_hal_sd.h and stm32f4xx_hal_sd.c
 
 
-import libscrc
-from bitarray import bitarray
+import functools
 from hal_fuzz.models.disk import Disk
 
 
-def crc_and_last_bit(input_bytes):
-    crc7 = libscrc.crc7(input_bytes)        # compute crc of vector
-    trail = (crc7 << 1)                     # shift by 1 bit to the left
-    trail = trail | 0x00000001              # set last bit to 1
-    trail = trail.to_bytes(1, 'big')        # encode to hex
-    return trail
+def _crc7_byte(index):
+    # CRC-7 (polynomial x^7 + x^3 + 1) of a single byte, computed on the crc shifted left by 1 bit
+    crc = index
+    for _ in range(8):
+        crc = (crc << 1) ^ 0x12 if crc & 0x80 else crc << 1
+    return (crc & 0xff) >> 1
 
 
+CRC7_TABLE = [_crc7_byte(i) for i in range(256)]
+
+
+def crc7(data):
+    """Table driven CRC-7 of data."""
+    crc = 0
+    for b in data:
+        crc = CRC7_TABLE[(crc << 1) ^ b]
+    return crc
+
+
+def _crc7_tail(partial):
+    # last byte of CID/CSD (15 bytes of fields before it): CRC-7 shifted left by 1 bit, end bit set to 1
+    return bytes(((crc7(partial) << 1) | 1,))
+
+
+@functools.lru_cache(maxsize=None)
 def compute_CID(MID, OID, PNM, PRV, PSN, RSV, MDT):
     # combine to byte level (a single hexadecimal char cannot be converted to "bytes" since it's only 4 bit)
     RSV_MDT = RSV << 3 | MDT
@@ -29,10 +45,11 @@ def compute_CID(MID, OID, PNM, PRV, PSN, RSV, MDT):
                   PSN.to_bytes(4, 'big') +\
                   RSV_MDT.to_bytes(2, 'big')
     # calculate CID
-    CID = partial_CID + crc_and_last_bit(partial_CID)
+    CID = partial_CID + _crc7_tail(partial_CID)
     # return CID
     return CID
 
+@functools.lru_cache(maxsize=None)
 def compute_CSD(
         CSD_STRUCTURE,
         RSV1,
@@ -64,38 +81,18 @@ def compute_CSD(
         FILE_FORMAT,
         RSV6
 ):
-    # create single array of bits
-    bitCSD = CSD_STRUCTURE +\
-             RSV1 +\
-             TAAC +\
-             NSAC +\
-             TRANS_SPEED +\
-             CCC +\
-             READ_BL_LEN +\
-             READ_BL_PARTIAL +\
-             WRITE_BLK_MISALIGN +\
-             READ_BLK_MISALIGN +\
-             DSR_IMP +\
-             RSV2 +\
-             C_SIZE +\
-             RSV3 +\
-             ERASE_BLK_EN +\
-             SECTOR_SIZE +\
-             WP_GRP_SIZE +\
-             WP_GRP_ENABLE +\
-             RSV4 +\
-             R2W_FACTOR +\
-             WRITE_BL_LEN +\
-             WRITE_BL_LEN2 +\
-             RSV5 +\
-             FILE_FORMAT_GRP +\
-             COPY +\
-             PERM_WRITE_PROTECT +\
-             TMP_WRITE_PROTECT +\
-             FILE_FORMAT +\
-             RSV6
-    partial_CSD = bitCSD.tobytes()  # convert to bytes
-    CSD = partial_CSD + crc_and_last_bit(partial_CSD)   # add CRC
+    # fields are (value, width in bits) pairs, from the most significant bit down
+    fields = (CSD_STRUCTURE, RSV1, TAAC, NSAC, TRANS_SPEED, CCC, READ_BL_LEN, READ_BL_PARTIAL,
+              WRITE_BLK_MISALIGN, READ_BLK_MISALIGN, DSR_IMP, RSV2, C_SIZE, RSV3, ERASE_BLK_EN, SECTOR_SIZE,
+              WP_GRP_SIZE, WP_GRP_ENABLE, RSV4, R2W_FACTOR, WRITE_BL_LEN, WRITE_BL_LEN2, RSV5, FILE_FORMAT_GRP,
+              COPY, PERM_WRITE_PROTECT, TMP_WRITE_PROTECT, FILE_FORMAT, RSV6)
+    # pack all the fields in a single integer (must be 120 bits, the CRC byte completes the register)
+    assert sum(width for _, width in fields) == 120
+    bitCSD = 0
+    for value, width in fields:
+        bitCSD = (bitCSD << width) | (value & ((1 << width) - 1))
+    partial_CSD = bitCSD.to_bytes(15, 'big')  # convert to bytes
+    CSD = partial_CSD + _crc7_tail(partial_CSD)   # add CRC
     return CSD
 
 
@@ -116,69 +113,59 @@ class SDModel:
     MDT = 0x112             # Production Date
 
     # CSD Register - Card Specific Data Register (128 bits)
-    CSD_STRUCTURE = bitarray('01')      # CSD structure version - 2 bits
-    RSV1 = bitarray('000000')           # Reserved - 6 bits
-    TAAC = bitarray()                   # 8 bits
-    TAAC.frombytes(0x0e.to_bytes(1, 'big'))
-    NSAC = bitarray()                   # 8 bits
-    NSAC.frombytes(0x00.to_bytes(1, 'big'))
-    TRANS_SPEED = bitarray()            # Max transfer speed - 8 bits
-    TRANS_SPEED.frombytes(0x5a.to_bytes(1, 'big'))
-    CCC = bitarray()                    # SD class - 12 bits
-    CCC.frombytes(0x5b5.to_bytes(2, 'big'))
-    CCC = CCC[-12:]
-    READ_BL_LEN = bitarray()            # 4 bits
-    READ_BL_LEN.frombytes(0x9.to_bytes(1, 'big'))
-    READ_BL_LEN = READ_BL_LEN[-4:]
-    READ_BL_PARTIAL = bitarray('0')     # 1 bit
-    WRITE_BLK_MISALIGN = bitarray('0')  # 1 bit
-    READ_BLK_MISALIGN = bitarray('0')   # 1 bit
-    DSR_IMP = bitarray('0')             # 1 bit
-    RSV2 = bitarray('000000')           # Reserved - 6 bits
-
-    C_SIZE = bitarray()                 # Size - 22 bits
-    C_SIZE.frombytes(0x00127F.to_bytes(3, 'big'))
-    C_SIZE = C_SIZE[-22:]
-
-    RSV3 = bitarray('0')                # Reserved - 1 bit
-    ERASE_BLK_EN = bitarray('1')        # 1 bit
-
-    SECTOR_SIZE = bitarray()            # 7 bits
-    SECTOR_SIZE.frombytes(0x7f.to_bytes(1, 'big'))
-    SECTOR_SIZE = SECTOR_SIZE[-7:]
-
-    WP_GRP_SIZE = bitarray('0000000')   # 7 bits
-    WP_GRP_ENABLE = bitarray('0')       # 1 bit
-    RSV4 = bitarray('00')               # Reserved - 2 bit
-
-    R2W_FACTOR = bitarray()             # 3 bits
-    R2W_FACTOR.frombytes(0x02.to_bytes(1, 'big'))
-    R2W_FACTOR = R2W_FACTOR[-3:]
-
-    WRITE_BL_LEN = bitarray()           # 4 bits
-    WRITE_BL_LEN.frombytes(0x09.to_bytes(1, 'big'))
-    WRITE_BL_LEN = WRITE_BL_LEN[-4:]
-    WRITE_BL_LEN2 = bitarray('0')       # 1 bit
-    RSV5 = bitarray('00000')            # Reserved - 5 bit
-    FILE_FORMAT_GRP = bitarray('0')     # 1 bit
-    COPY = bitarray('0')                # 1 bit
-    PERM_WRITE_PROTECT = bitarray('0')  # 1 bit
-    TMP_WRITE_PROTECT = bitarray('0')   # 1 bit
-
-
-    FILE_FORMAT = bitarray('00')        # 2 bit
-    RSV6 = bitarray('00')               # 2 bit
-
-
-    CSD = compute_CSD(CSD_STRUCTURE, RSV1, TAAC, NSAC, TRANS_SPEED, CCC, READ_BL_LEN, READ_BL_PARTIAL,
-                      WRITE_BLK_MISALIGN, READ_BLK_MISALIGN, DSR_IMP, RSV2, C_SIZE, RSV3, ERASE_BLK_EN,
-                      SECTOR_SIZE, WP_GRP_SIZE, WP_GRP_ENABLE, RSV4, R2W_FACTOR, WRITE_BL_LEN, WRITE_BL_LEN2,
-                      RSV5, FILE_FORMAT_GRP, COPY, PERM_WRITE_PROTECT, TMP_WRITE_PROTECT, FILE_FORMAT, RSV6)
-
-
-    CID = compute_CID(MID, OID, PNM, PRV, PSN, RSV, MDT)
-
-    # initialize empty disk
-    disk = Disk(BLOCK_SIZE)
-
-    # input is loaded from SD HAL during HAL_SD_Init()
+    # each field is a pair (value, width in bits)
+    CSD_STRUCTURE = (0x1, 2)            # CSD structure version
+    RSV1 = (0x00, 6)                    # Reserved
+    TAAC = (0x0e, 8)
+    NSAC = (0x00, 8)
+    TRANS_SPEED = (0x5a, 8)             # Max transfer speed
+    CCC = (0x5b5, 12)                   # SD class
+    READ_BL_LEN = (0x9, 4)
+    READ_BL_PARTIAL = (0x0, 1)
+    WRITE_BLK_MISALIGN = (0x0, 1)
+    READ_BLK_MISALIGN = (0x0, 1)
+    DSR_IMP = (0x0, 1)
+    RSV2 = (0x00, 6)                    # Reserved
+    C_SIZE = (0x00127F, 22)             # Size
+    RSV3 = (0x0, 1)                     # Reserved
+    ERASE_BLK_EN = (0x1, 1)
+    SECTOR_SIZE = (0x7f, 7)
+    WP_GRP_SIZE = (0x00, 7)
+    WP_GRP_ENABLE = (0x0, 1)
+    RSV4 = (0x0, 2)                     # Reserved
+    R2W_FACTOR = (0x2, 3)
+    WRITE_BL_LEN = (0x9, 4)
+    WRITE_BL_LEN2 = (0x0, 1)
+    RSV5 = (0x00, 5)                    # Reserved
+    FILE_FORMAT_GRP = (0x0, 1)
+    COPY = (0x0, 1)
+    PERM_WRITE_PROTECT = (0x0, 1)
+    TMP_WRITE_PROTECT = (0x0, 1)
+    FILE_FORMAT = (0x0, 2)
+    RSV6 = (0x0, 2)
+
+    # CID and CSD are constant, they are precomputed from the fields above
+    # (run this module as a script to regenerate them after changing a field)
+    CSD = bytes.fromhex('400e005a5b590000127f7f800a400093')
+    CID = bytes.fromhex('41343253444349543012345678011257')
+
+    def __init__(self):
+        # initialize empty disk, owned by this card
+        # input is loaded from SD HAL during HAL_SD_Init()
+        # the capacity (in blocks) is the one the HAL computes from C_SIZE: (C_SIZE + 1) * 1024
+        self.disk = Disk(self.BLOCK_SIZE, (self.C_SIZE[0] + 1) * 1024)
+
+
+if __name__ == '__main__':
+    CSD = compute_CSD(SDModel.CSD_STRUCTURE, SDModel.RSV1, SDModel.TAAC, SDModel.NSAC, SDModel.TRANS_SPEED,
+                      SDModel.CCC, SDModel.READ_BL_LEN, SDModel.READ_BL_PARTIAL, SDModel.WRITE_BLK_MISALIGN,
+                      SDModel.READ_BLK_MISALIGN, SDModel.DSR_IMP, SDModel.RSV2, SDModel.C_SIZE, SDModel.RSV3,
+                      SDModel.ERASE_BLK_EN, SDModel.SECTOR_SIZE, SDModel.WP_GRP_SIZE, SDModel.WP_GRP_ENABLE,
+                      SDModel.RSV4, SDModel.R2W_FACTOR, SDModel.WRITE_BL_LEN, SDModel.WRITE_BL_LEN2, SDModel.RSV5,
+                      SDModel.FILE_FORMAT_GRP, SDModel.COPY, SDModel.PERM_WRITE_PROTECT, SDModel.TMP_WRITE_PROTECT,
+                      SDModel.FILE_FORMAT, SDModel.RSV6)
+    CID = compute_CID(SDModel.MID, SDModel.OID, SDModel.PNM, SDModel.PRV, SDModel.PSN, SDModel.RSV, SDModel.MDT)
+    print("CSD = bytes.fromhex('{}')".format(CSD.hex()))
+    print("CID = bytes.fromhex('{}')".format(CID.hex()))
+    if CSD != SDModel.CSD or CID != SDModel.CID:
+        print("precomputed values are out of date!")
@@ -341,15 +341,14 @@ class FFSMU:
                 self.disk.write(pos, entry) # write to disk
 
                 # write file content to clusters
-                f = open(file, "rb")
-                remaining = size
-                while remaining > 0:
-                    # read file one cluster at the time and write it to the disk
-                    content = f.read(self.CLUSTER_SIZE)
-                    remaining = remaining - len(content)
-                    curr_clust = allocated_clusters.pop(0)
-                    self.write_cluster(curr_clust, content, True)
-                f.close()
+                with open(file, "rb") as f:
+                    remaining = size
+                    while remaining > 0:
+                        # read file one cluster at the time and write it to the disk
+                        content = f.read(self.CLUSTER_SIZE)
+                        remaining = remaining - len(content)
+                        curr_clust = allocated_clusters.pop(0)
+                        self.write_cluster(curr_clust, content, True)
 
                 if len(allocated_clusters) != 0:
                     print("import_file() exception!")   # sanity check, after importing we should have used all clusters